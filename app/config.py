@@ -1,8 +1,10 @@
 from pathlib import Path
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", frozen=True)
+    
     # Google Drive settings
     GOOGLE_SERVICE_ACCOUNT_FILE: Path
     
@@ -14,12 +16,11 @@ class Settings(BaseSettings):
     # App settings
     WEBHOOK_URL: str
     DATABASE_URL: str = "sqlite:///./app.db"
+    # No longer used (files stream straight to Dify); kept so existing
+    # .env files that still set it continue to load
     TEMP_DOWNLOAD_PATH: Path = Path("./temp")
-    
-    class Config:
-        env_file = ".env"
 
-@lru_cache()
+@lru_cache(maxsize=None)
 def get_settings() -> Settings:
     return Settings()
 
@@ -1,16 +1,42 @@
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from datetime import datetime, timedelta
+from typing import Optional
+import uuid
+from sqlalchemy import create_engine, event, inspect, or_, text, Boolean, Column, Integer, String, DateTime
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from .config import settings
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    pool_size=20,  # Increased from default 5
-    max_overflow=30,  # Increased from default 10
-    pool_timeout=60,  # Increased from default 30
-    pool_pre_ping=True  # Enable connection health checks
-)
+IS_SQLITE = settings.DATABASE_URL.startswith("sqlite")
+
+if IS_SQLITE:
+    engine = create_engine(
+        settings.DATABASE_URL,
+        connect_args={
+            "check_same_thread": False,  # Sessions are used from worker tasks
+            "timeout": 30  # Wait on locks instead of failing immediately
+        }
+    )
+    
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers proceed during writes; NORMAL sync is durable
+        # across application crashes and avoids an fsync per commit.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+        cursor.close()
+else:
+    engine = create_engine(
+        settings.DATABASE_URL,
+        pool_size=20,  # Increased from default 5
+        max_overflow=30,  # Increased from default 10
+        pool_timeout=60,  # Increased from default 30
+        pool_pre_ping=True  # Enable connection health checks
+    )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -28,10 +54,179 @@ class NotificationChannel(Base):
     id = Column(Integer, primary_key=True)
     channel_id = Column(String, unique=True, index=True)
     folder_id = Column(String)
-    expiration = Column(DateTime)
+    expiration = Column(DateTime, index=True)
+    start_page_token = Column(String)  # Drive Changes API position
+
+class ProcessingFile(Base):
+    __tablename__ = "processing_files"
+    
+    file_id = Column(String, primary_key=True)
+    claimed_at = Column(DateTime, default=datetime.utcnow)
+    owner = Column(String)  # Token identifying the worker holding the claim
+
+class FailedFile(Base):
+    __tablename__ = "failed_files"
+    
+    file_id = Column(String, primary_key=True)
+    file_name = Column(String)
+    attempts = Column(Integer, default=0)
+    permanent = Column(Boolean, default=False)  # Retrying will not help
+    last_error = Column(String)
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
+# Files failing transiently this many times are skipped like permanent failures
+MAX_FILE_ATTEMPTS = 3
+
+class FolderCheck(Base):
+    __tablename__ = "folder_checks"
+    
+    folder_id = Column(String, primary_key=True)
+    checked_at = Column(DateTime)
+
+# Claims not refreshed within this are assumed to belong to a crashed worker
+CLAIM_TTL = timedelta(minutes=10)
+CLAIM_REFRESH_INTERVAL = CLAIM_TTL / 3
+
+def dialect_insert(model):
+    """INSERT supporting ON CONFLICT clauses for the configured dialect."""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(
+        f"Unsupported database dialect: {engine.dialect.name} (use SQLite or PostgreSQL)"
+    )
+
+def insert_ignore(model):
+    """INSERT ... ON CONFLICT DO NOTHING for the configured dialect."""
+    return dialect_insert(model).on_conflict_do_nothing()
+
+def claim_file(db: Session, file_id: str) -> Optional[str]:
+    """Atomically claim a file for processing across all workers.
+    
+    Returns the claim's owner token, or None if another worker already
+    holds the claim or the file has already been processed. Long-running
+    work must call refresh_claim at least every CLAIM_REFRESH_INTERVAL to
+    keep it.
+    """
+    now = datetime.utcnow()
+    owner = uuid.uuid4().hex
+    db.query(ProcessingFile).filter(
+        ProcessingFile.file_id == file_id,
+        ProcessingFile.claimed_at < now - CLAIM_TTL
+    ).delete()
+    result = db.execute(
+        insert_ignore(ProcessingFile).values(file_id=file_id, claimed_at=now, owner=owner)
+    )
+    if result.rowcount != 1:
+        db.commit()
+        return None
+    
+    # Checked after the insert: a previous holder records the file before
+    # releasing its claim, so a successful claim sees that row if it exists
+    if db.query(ProcessedFile.id).filter_by(file_id=file_id).first():
+        db.rollback()
+        return None
+    
+    db.commit()
+    return owner
+
+def refresh_claim(db: Session, file_id: str, owner: str) -> bool:
+    """Extend a claim taken with claim_file; False if it has been lost."""
+    refreshed = db.query(ProcessingFile).filter(
+        ProcessingFile.file_id == file_id,
+        ProcessingFile.owner == owner
+    ).update({ProcessingFile.claimed_at: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return refreshed == 1
+
+def release_claim(db: Session, file_id: str, owner: str):
+    """Release a claim taken with claim_file, if this owner still holds it."""
+    db.query(ProcessingFile).filter(
+        ProcessingFile.file_id == file_id,
+        ProcessingFile.owner == owner
+    ).delete()
+    db.commit()
+
+def acquire_folder_check(db: Session, folder_id: str, interval: timedelta) -> bool:
+    """Atomically record a folder check across all workers.
+    
+    Returns False if the folder was already checked within interval.
+    """
+    now = datetime.utcnow()
+    acquired = db.query(FolderCheck).filter(
+        FolderCheck.folder_id == folder_id,
+        FolderCheck.checked_at <= now - interval
+    ).update({FolderCheck.checked_at: now}, synchronize_session=False)
+    if not acquired:
+        acquired = db.execute(
+            insert_ignore(FolderCheck).values(folder_id=folder_id, checked_at=now)
+        ).rowcount
+    db.commit()
+    return acquired == 1
+
+def record_failure(db: Session, file_id: str, file_name: str, error: str, permanent: bool):
+    """Count a failed processing attempt for a file."""
+    now = datetime.utcnow()
+    stmt = dialect_insert(FailedFile).values(
+        file_id=file_id,
+        file_name=file_name,
+        attempts=1,
+        permanent=permanent,
+        last_error=error,
+        failed_at=now
+    )
+    updates = {
+        "attempts": FailedFile.attempts + 1,
+        "last_error": error,
+        "failed_at": now
+    }
+    if permanent:
+        updates["permanent"] = True
+    db.execute(stmt.on_conflict_do_update(index_elements=[FailedFile.file_id], set_=updates))
+    db.commit()
+
+def settled_file_ids(db: Session, file_ids: list) -> set:
+    """Return the IDs that need no further processing.
+    
+    A file is settled once it is processed, has failed permanently, or has
+    used up MAX_FILE_ATTEMPTS.
+    """
+    if not file_ids:
+        return set()
+    processed = db.query(ProcessedFile.file_id)\
+        .filter(ProcessedFile.file_id.in_(file_ids))
+    given_up = db.query(FailedFile.file_id).filter(
+        FailedFile.file_id.in_(file_ids),
+        or_(FailedFile.permanent, FailedFile.attempts >= MAX_FILE_ATTEMPTS)
+    )
+    return {r[0] for r in processed.union(given_up).all()}
+
+def advance_page_token(db: Session, channel_pk: int, page_token: Optional[str], next_page_token: str):
+    """Move a channel's Changes API token forward unless another worker already has."""
+    current = NotificationChannel.start_page_token
+    unchanged = current.is_(None) if page_token is None else current == page_token
+    db.query(NotificationChannel).filter(
+        NotificationChannel.id == channel_pk,
+        unchanged
+    ).update({current: next_page_token}, synchronize_session=False)
+    db.commit()
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all skips existing tables, so add indexes introduced later
+    for index in NotificationChannel.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    # ... and columns
+    added_columns = (
+        ("notification_channels", "start_page_token"),
+        ("processing_files", "owner"),
+    )
+    inspector = inspect(engine)
+    for table, column in added_columns:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} VARCHAR"))
 
 def get_db():
     db = SessionLocal()
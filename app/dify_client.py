@@ -1,48 +1,133 @@
-from typing import Optional
+from typing import AsyncIterator, Awaitable, Callable, Optional
 import httpx
 import asyncio
-from pathlib import Path
+import logging
+import os
 
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
+# HTML5 form encoding for filenames in part headers, as httpx does: quotes
+# and control characters (including CR/LF) are percent-encoded
+_FILENAME_ESCAPES = {'"': "%22", "\\": "\\\\"}
+_FILENAME_ESCAPES.update({chr(c): f"%{c:02X}" for c in range(0x20)})
+_FILENAME_ESCAPE_TABLE = str.maketrans(_FILENAME_ESCAPES)
+
+class UploadRejected(Exception):
+    """The upload failed in a way that retrying will not fix."""
+
 class DifyClient:
     def __init__(self):
         self.base_url = settings.DIFY_BASE_URL
         self.headers = {
             "Authorization": f"Bearer {settings.DIFY_API_KEY}"
         }
+        # Single pooled client so uploads reuse keep-alive connections
+        # instead of paying a TCP + TLS handshake per request.
+        # Connection failures are retried at the transport level.
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=httpx.Timeout(60.0),  # Increased timeout for large files
+            # Pool limits must live on the transport; the client ignores
+            # limits= when a custom transport is supplied
+            transport=httpx.AsyncHTTPTransport(
+                retries=3,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        )
+    
+    async def aclose(self):
+        """Close the underlying HTTP connection pool."""
+        await self._client.aclose()
     
-    async def upload_file(self, file_path: Path, retries: int = 3) -> Optional[str]:
-        """Upload a file to Dify dataset."""
-        url = f"{self.base_url}/datasets/{settings.DIFY_DATASET_ID}/document/create-by-file"
+    @staticmethod
+    def _multipart(
+        file_name: str,
+        chunks: AsyncIterator[bytes],
+        size: Optional[int] = None
+    ) -> tuple[dict, AsyncIterator[bytes]]:
+        """Build a streaming multipart/form-data body for a single file field."""
+        boundary = os.urandom(16).hex()
+        safe_name = file_name.translate(_FILENAME_ESCAPE_TABLE)
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        if size is not None:
+            headers["Content-Length"] = str(len(head) + size + len(tail))
+        
+        async def body() -> AsyncIterator[bytes]:
+            yield head
+            async for chunk in chunks:
+                yield chunk
+            yield tail
+        
+        return headers, body()
+    
+    async def upload_stream(
+        self,
+        file_name: str,
+        open_source: Callable[[], Awaitable[httpx.Response]],
+        size: Optional[int] = None,
+        retries: int = 3
+    ) -> Optional[str]:
+        """Upload a streamed HTTP response body to Dify dataset as a file.
+        
+        open_source is awaited on every attempt so retries restart the source.
+        It is opened before the Dify request starts, so a source that fails
+        with a 4xx status is not retried.
+        Without a size the body is sent with chunked transfer encoding.
+        
+        Returns the document id, or None once retries are exhausted. Raises
+        UploadRejected when the source or Dify answers with a client error.
+        """
+        url = f"/datasets/{settings.DIFY_DATASET_ID}/document/create-by-file"
         
         for attempt in range(retries):
             try:
                 if attempt > 0:
-                    print(f"[INFO] Retry {attempt + 1}/{retries}")
-                async with httpx.AsyncClient() as client:
-                    with open(file_path, "rb") as f:
-                        files = {"file": (file_path.name, f, "application/octet-stream")}
-                        response = await client.post(
-                            url,
-                            headers=self.headers,
-                            files=files,
-                            timeout=60.0  # Increased timeout for large files
-                        )
-                        
-                        if response.status_code != 200:
-                            if attempt == retries - 1:
-                                print(f"[ERROR] Dify API error: {response.status_code} - {response.text}")
-                                return None
-                            continue
-                            
-                        result = response.json()
-                        return result.get("id")
-                        
+                    logger.info("Retry %d/%d", attempt + 1, retries)
+                source = await open_source()
+                try:
+                    headers, body = self._multipart(file_name, source.aiter_bytes(), size=size)
+                    response = await self._client.post(url, headers=headers, content=body)
+                finally:
+                    await source.aclose()
+                
+                if response.status_code != 200:
+                    # Client errors will not succeed on retry
+                    if response.status_code < 500:
+                        raise UploadRejected(f"Dify API error: {response.status_code} - {response.text}")
+                    if attempt == retries - 1:
+                        logger.error("Dify API error: %s - %s", response.status_code, response.text)
+                        return None
+                    await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                    continue
+                    
+                result = response.json()
+                return result.get("id")
+                
+            except UploadRejected:
+                raise
+            except httpx.HTTPStatusError as e:
+                # Raised by the source; client errors will not succeed on retry
+                if e.response.status_code < 500:
+                    raise UploadRejected(f"Source error: {e}") from e
+                if attempt == retries - 1:
+                    logger.error("Source error for %s: %s", file_name, e)
+                    return None
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                continue
             except Exception as e:
                 if attempt == retries - 1:
-                    print(f"[ERROR] Dify upload failed: {str(e)}")
+                    logger.error("Dify upload failed: %s", e)
                     return None
-                await asyncio.sleep(2)  # Wait before retry
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
                 continue
         return None
@@ -1,39 +1,91 @@
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Tuple
+import asyncio
 import json
+import logging
+import threading
 
+import httplib2
+import httpx
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import HttpRequest
 from google.auth.transport.requests import Request
 
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+# Folders and Google-native documents have no binary content to download
+GOOGLE_APPS_MIME_PREFIX = 'application/vnd.google-apps.'
+
 class GoogleDriveService:
     def __init__(self):
         try:
-            print(f"Initializing Google Drive service with credentials from: {settings.GOOGLE_SERVICE_ACCOUNT_FILE}")
+            logger.info("Initializing Google Drive service with credentials from: %s", settings.GOOGLE_SERVICE_ACCOUNT_FILE)
             credentials = service_account.Credentials.from_service_account_file(
                 str(settings.GOOGLE_SERVICE_ACCOUNT_FILE),
                 scopes=SCOPES
             )
-            self.service = build('drive', 'v3', credentials=credentials)
-            print("Successfully initialized Google Drive service")
+            self.credentials = credentials
+            self._local = threading.local()
+            self.service = build(
+                'drive', 'v3',
+                http=self._authorized_http(),
+                requestBuilder=self._build_request,
+                cache_discovery=False
+            )
+            # Async client for streaming media straight to consumers
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(60.0))
+            logger.info("Successfully initialized Google Drive service")
         except Exception as e:
-            print(f"Error initializing Google Drive service: {str(e)}")
+            logger.error("Error initializing Google Drive service: %s", e)
             raise
     
+    def _authorized_http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """Return this thread's persistent authorized HTTP connection.
+        
+        httplib2 is not thread-safe, so each worker thread keeps its own
+        connection while sharing one set of (refreshed) credentials.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+            self._local.http = http
+        return http
+    
+    async def aclose(self):
+        """Close the streaming HTTP connection pool."""
+        await self._client.aclose()
+    
+    async def _access_token(self) -> str:
+        """Return a valid OAuth access token, refreshing it off the event loop."""
+        if not self.credentials.valid:
+            await asyncio.to_thread(
+                self.credentials.refresh,
+                google_auth_httplib2.Request(httplib2.Http())
+            )
+        return self.credentials.token
+    
+    def _build_request(self, http, *args, **kwargs) -> HttpRequest:
+        # Bind requests to the executing thread's connection rather than
+        # the one captured when the service was built.
+        return HttpRequest(_ThreadLocalHttp(self), *args, **kwargs)
+    
     async def setup_watch(self, folder_id: str) -> Dict[str, Any]:
         """Setup webhook notification for a folder."""
         try:
-            print(f"Setting up watch for folder: {folder_id}")
+            logger.info("Setting up watch for folder: %s", folder_id)
             
             # First verify folder exists and is accessible
             try:
-                self.service.files().get(fileId=folder_id).execute()
-                print(f"Successfully verified folder access: {folder_id}")
+                await asyncio.to_thread(self.service.files().get(fileId=folder_id).execute)
+                logger.info("Successfully verified folder access: %s", folder_id)
             except Exception as e:
                 raise Exception(f"Cannot access folder. Make sure the folder exists and is shared with the service account. Error: {str(e)}")
             
@@ -47,51 +99,107 @@ class GoogleDriveService:
                 'expiration': expiration
             }
             
-            print(f"Sending watch request with body: {body}")
-            response = self.service.files().watch(
-                fileId=folder_id,
-                body=body
-            ).execute()
-            print(f"Watch response: {response}")
+            logger.info("Sending watch request with body: %s", body)
+            response = await asyncio.to_thread(
+                self.service.files().watch(fileId=folder_id, body=body).execute
+            )
+            logger.info("Watch response: %s", response)
+            
+            # Changes after this point are picked up by list_new_files
+            start_page_token = await self.get_start_page_token()
             
             return {
                 'channel_id': response['id'],
                 'folder_id': folder_id,
-                'expiration': datetime.fromtimestamp(int(response['expiration']) / 1000)
+                'expiration': datetime.utcfromtimestamp(int(response['expiration']) / 1000),
+                'start_page_token': start_page_token
             }
         except Exception as e:
-            print(f"Error in setup_watch: {str(e)}")
+            logger.error("Error in setup_watch: %s", e)
             raise
     
-    async def list_new_files(self, folder_id: str, time_window: int = 300) -> List[Dict[str, Any]]:
-        """List files created in the last time_window seconds."""
+    async def get_start_page_token(self) -> str:
+        """Get the Changes API token for the current state of Drive."""
+        response = await asyncio.to_thread(
+            self.service.changes().getStartPageToken(supportsAllDrives=True).execute
+        )
+        return response['startPageToken']
+    
+    async def list_recent_files(self, folder_id: str, time_window: int = 300) -> List[Dict[str, Any]]:
+        """List files created in the last time_window seconds.
+        
+        Only used for channels that predate change tracking, on their
+        first notification.
+        """
         query_time = (datetime.utcnow() - timedelta(seconds=time_window)).isoformat('T') + 'Z'
         
-        query = f"'{folder_id}' in parents and createdTime > '{query_time}'"
+        query = f"'{folder_id}' in parents and createdTime > '{query_time}' and trashed = false"
         
-        results = self.service.files().list(
+        request = self.service.files().list(
             q=query,
             spaces='drive',
-            fields='files(id, name, createdTime, mimeType)',
+            fields='files(id, name, size, createdTime, mimeType)',
             includeItemsFromAllDrives=True,
             supportsAllDrives=True
-        ).execute()
+        )
+        results = await asyncio.to_thread(request.execute)
         
-        return results.get('files', [])
+        return [
+            f for f in results.get('files', [])
+            if not f.get('mimeType', '').startswith(GOOGLE_APPS_MIME_PREFIX)
+        ]
     
-    async def download_file(self, file_id: str, destination_path: str) -> bool:
-        """Download a file from Drive to local storage."""
-        try:
-            request = self.service.files().get_media(fileId=file_id)
-            with open(destination_path, 'wb') as f:
-                downloader = MediaIoBaseDownload(f, request)
-                done = False
-                while not done:
-                    _, done = downloader.next_chunk()
-            return True
-        except Exception as e:
-            print(f"Error downloading file {file_id}: {str(e)}")
-            return False
+    async def list_new_files(self, folder_id: str, page_token: str) -> Tuple[List[Dict[str, Any]], str]:
+        """List files in a folder that changed since page_token.
+        
+        Returns the files and the token to resume from on the next call.
+        """
+        files = {}
+        while True:
+            request = self.service.changes().list(
+                pageToken=page_token,
+                fields='nextPageToken, newStartPageToken, '
+                       'changes(fileId, removed, file(id, name, size, mimeType, parents, trashed))',
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                restrictToMyDrive=False,
+                pageSize=1000
+            )
+            response = await asyncio.to_thread(request.execute)
+            
+            for change in response.get('changes', []):
+                file = change.get('file')
+                if change.get('removed') or not file or file.get('trashed'):
+                    continue
+                if folder_id not in file.get('parents', []):
+                    continue
+                if file.get('mimeType', '').startswith(GOOGLE_APPS_MIME_PREFIX):
+                    continue
+                files[file['id']] = file
+            
+            if 'newStartPageToken' in response:
+                return list(files.values()), response['newStartPageToken']
+            page_token = response['nextPageToken']
+    
+    async def open_file_stream(self, file_id: str) -> httpx.Response:
+        """Open a streaming download of a file's contents.
+        
+        The status is checked before returning, so errors raise
+        httpx.HTTPStatusError before any body is consumed. The caller
+        must close the returned response.
+        """
+        token = await self._access_token()
+        request = self._client.build_request(
+            'GET',
+            f"{DRIVE_FILES_URL}/{file_id}",
+            params={'alt': 'media', 'supportsAllDrives': 'true'},
+            headers={'Authorization': f"Bearer {token}"}
+        )
+        response = await self._client.send(request, stream=True)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
     
     async def stop_watch(self, channel_id: str, resource_id: str) -> bool:
         """Stop watching a folder."""
@@ -100,8 +208,24 @@ class GoogleDriveService:
                 'id': channel_id,
                 'resourceId': resource_id
             }
-            self.service.channels().stop(body=body).execute()
+            await asyncio.to_thread(self.service.channels().stop(body=body).execute)
             return True
         except Exception as e:
-            print(f"Error stopping watch: {str(e)}")
+            logger.error("Error stopping watch: %s", e)
             return False
+
+
+class _ThreadLocalHttp:
+    """Proxy that resolves the calling thread's AuthorizedHttp on each use."""
+    
+    def __init__(self, drive_service: GoogleDriveService):
+        self._drive_service = drive_service
+    
+    def __getattr__(self, name):
+        return getattr(self._drive_service._authorized_http(), name)
+
+
+@lru_cache(maxsize=None)
+def get_drive_service() -> GoogleDriveService:
+    """Return the shared Google Drive service instance."""
+    return GoogleDriveService()
@@ -1,26 +1,71 @@
-from fastapi import FastAPI, BackgroundTasks, Depends, Header, HTTPException
+from fastapi import FastAPI, Depends, Header, HTTPException
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from pathlib import Path
-import shutil
+import asyncio
+import logging
+import logging.handlers
+import queue
 from typing import Optional
+from datetime import timedelta
 
-from .config import settings
-from .database import get_db, init_db, ProcessedFile, NotificationChannel
-from .google_drive import GoogleDriveService
-from .dify_client import DifyClient
+from .database import (
+    get_db, init_db, SessionLocal, ProcessedFile, NotificationChannel,
+    claim_file, refresh_claim, release_claim, acquire_folder_check, insert_ignore,
+    advance_page_token, record_failure, settled_file_ids, CLAIM_REFRESH_INTERVAL
+)
+from .google_drive import get_drive_service
+from .dify_client import DifyClient, UploadRejected
 from .scheduler import start_scheduler
 
 from time import time
 
+logger = logging.getLogger(__name__)
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+    
+    The stock prepare() formats each record on the emitting thread (here
+    the event loop) so it can be pickled; an in-process queue doesn't need
+    that. Log arguments must not be mutated after the logging call.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """Route app logs through a queue so formatting and I/O run on a background thread."""
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    
+    app_logger = logging.getLogger("app")
+    app_logger.setLevel(logging.INFO)
+    app_logger.addHandler(DeferredFormatQueueHandler(log_queue))
+    app_logger.propagate = False
+    
+    listener.start()
+    return listener
+
+# Configured at import so service initialization below is logged too
+log_listener = configure_logging()
+
 app = FastAPI(title="Drive Monitor API")
-drive_service = GoogleDriveService()
+drive_service = get_drive_service()
 dify_client = DifyClient()
 
-# Track files being processed
-processing_files = set()
+# At most MAX_CONCURRENT_FILES files stream from Drive to Dify at once,
+# across all webhooks. The semaphore is created on startup so it binds to
+# the running event loop.
+MAX_CONCURRENT_FILES = 8
+file_semaphore: asyncio.Semaphore = None
+# Strong references to in-flight fan-out tasks so they are not collected
+fanout_tasks = set()
 
-# Debounce settings
+# Debounce settings. The shared check lives in the database; this dict is a
+# per-process L1 that skips the round-trip for repeated notifications.
 LAST_CHECK_TIME = {}
 DEBOUNCE_INTERVAL = 5  # seconds
 
@@ -29,17 +74,37 @@ async def startup_event():
     # Create database tables
     init_db()
     
-    # Create temp directory if it doesn't exist
-    settings.TEMP_DOWNLOAD_PATH.mkdir(parents=True, exist_ok=True)
+    # Warm the connection pool, channel pages and Drive credentials so the
+    # first webhook doesn't pay for them
+    try:
+        with SessionLocal() as db:
+            db.query(NotificationChannel).all()
+        await asyncio.to_thread(
+            drive_service.service.about().get(fields='user').execute
+        )
+    except Exception as e:
+        logger.warning("Startup warm-up failed: %s", e)
+    
+    # Bound concurrent file processing
+    global file_semaphore
+    file_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
     
     # Start the scheduler
     start_scheduler()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    # Clean up temp directory
-    if settings.TEMP_DOWNLOAD_PATH.exists():
-        shutil.rmtree(settings.TEMP_DOWNLOAD_PATH)
+    # Stop in-flight file processing
+    for task in fanout_tasks:
+        task.cancel()
+    await asyncio.gather(*fanout_tasks, return_exceptions=True)
+    
+    # Close pooled HTTP connections
+    await dify_client.aclose()
+    await drive_service.aclose()
+    
+    # Flush queued log records
+    log_listener.stop()
 
 @app.get("/health")
 async def health_check():
@@ -51,7 +116,7 @@ async def setup_monitoring(
     db: Session = Depends(get_db)
 ):
     try:
-        print(f"Attempting to setup monitoring for folder: {folder_id}")
+        logger.info("Attempting to setup monitoring for folder: %s", folder_id)
         
         # Verify drive service is initialized
         if not drive_service or not drive_service.service:
@@ -59,95 +124,153 @@ async def setup_monitoring(
             
         # Setup webhook notification
         channel = await drive_service.setup_watch(folder_id)
-        print(f"Successfully created watch channel: {channel}")
+        logger.info("Successfully created watch channel: %s", channel)
         
         # Store channel info
         db_channel = NotificationChannel(
             channel_id=channel['channel_id'],
             folder_id=channel['folder_id'],
-            expiration=channel['expiration']
+            expiration=channel['expiration'],
+            start_page_token=channel['start_page_token']
         )
         db.add(db_channel)
         db.commit()
         
         return {"message": "Monitoring setup successfully", "channel": channel}
     except Exception as e:
-        print(f"Error in setup_monitoring: {str(e)}")
+        logger.error("Error in setup_monitoring: %s", e)
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-import asyncio
-
-async def process_file(
-    file_id: str,
-    file_name: str,
-    db: Session
-):
-    """Background task to process a new file."""
-    temp_path = settings.TEMP_DOWNLOAD_PATH / file_name
-    
+async def process_file(file_id: str, file_name: str, size: Optional[int] = None):
+    """Stream a new file from Drive to Dify and record it as processed."""
+    owner = None
+    heartbeat = None
     try:
-        # Check if file is already being processed
-        if file_id in processing_files:
-            print(f"[INFO] File {file_name} is already in process")
-            return
-            
-        # Mark file as being processed
-        processing_files.add(file_id)
-            
-        # Check if file was already processed
-        existing = db.query(ProcessedFile).filter_by(file_id=file_id).first()
-        if existing:
+        # Claim the file so no other worker processes it concurrently
+        with SessionLocal() as db:
+            owner = claim_file(db, file_id)
+        if not owner:
+            logger.info("File %s is already processed or in process", file_name)
             return
         
-        # Download file with delay
-        print(f"[INFO] Processing {file_name}...")
+        # Streams have no overall deadline, so keep the claim alive until done
+        heartbeat = asyncio.create_task(hold_claim(file_id, owner))
+        
+        logger.info("Processing %s...", file_name)
         await asyncio.sleep(2)  # Wait 2 seconds before download
-        success = await drive_service.download_file(file_id, str(temp_path))
-        if not success:
-            print(f"[ERROR] Failed to download: {file_name}")
-            return
         
-        # Upload to Dify
-        document_id = await dify_client.upload_file(temp_path)
+        # Pipe Drive's media response straight into the Dify upload
+        document_id = await dify_client.upload_stream(
+            file_name,
+            lambda: drive_service.open_file_stream(file_id),
+            size=size
+        )
         if not document_id:
-            print(f"[ERROR] Failed to upload to Dify: {file_name}")
+            logger.error("Failed to upload to Dify: %s", file_name)
+            note_failure(file_id, file_name, "Upload retries exhausted", permanent=False)
             return
         
-        # Mark as processed
-        db_file = ProcessedFile(file_id=file_id, file_name=file_name)
-        db.add(db_file)
-        db.commit()
+        # Mark as processed; idempotent if another worker got there first.
+        # The session is only held for the insert.
+        with SessionLocal() as db:
+            db.execute(
+                insert_ignore(ProcessedFile).values(file_id=file_id, file_name=file_name)
+            )
+            db.commit()
         
-        print(f"Successfully processed file: {file_name}")
+        logger.info("Successfully processed file: %s", file_name)
+    except UploadRejected as e:
+        logger.error("Upload of %s rejected, not retrying: %s", file_name, e)
+        note_failure(file_id, file_name, str(e), permanent=True)
     except Exception as e:
-        print(f"Error processing file {file_name}: {str(e)}")
-        db.rollback()
+        logger.error("Error processing file %s: %s", file_name, e)
+        note_failure(file_id, file_name, str(e), permanent=False)
     finally:
-        # Remove from processing set
-        try:
-            processing_files.remove(file_id)
-        except KeyError:
-            # File was already removed by another process
-            pass
-        # Cleanup temp file
-        if temp_path.exists():
+        if heartbeat:
+            heartbeat.cancel()
+        if owner:
             try:
-                temp_path.unlink()
+                with SessionLocal() as db:
+                    release_claim(db, file_id, owner)
             except Exception as e:
-                print(f"[WARN] Failed to clean up {file_name}: {e}")
+                logger.warning("Failed to release claim on %s: %s", file_id, e)
+
+def note_failure(file_id: str, file_name: str, error: str, permanent: bool):
+    """Record a failed attempt so the file is eventually skipped."""
+    try:
+        with SessionLocal() as db:
+            record_failure(db, file_id, file_name, error, permanent)
+    except Exception as e:
+        logger.warning("Failed to record failure for %s: %s", file_id, e)
+
+async def hold_claim(file_id: str, owner: str):
+    """Refresh a processing claim until cancelled."""
+    while True:
+        await asyncio.sleep(CLAIM_REFRESH_INTERVAL.total_seconds())
+        try:
+            with SessionLocal() as db:
+                if not refresh_claim(db, file_id, owner):
+                    logger.warning("Lost processing claim on %s", file_id)
+                    return
+        except Exception as e:
+            logger.warning("Failed to refresh claim on %s: %s", file_id, e)
+
+async def process_files(files: list):
+    """Process files concurrently, bounded by the shared semaphore."""
+    async def limited(file):
+        async with file_semaphore:
+            size = int(file['size']) if 'size' in file else None
+            await process_file(file['id'], file['name'], size)
+    
+    results = await asyncio.gather(
+        *(limited(file) for file in files),
+        return_exceptions=True
+    )
+    for file, result in zip(files, results):
+        if isinstance(result, Exception):
+            logger.error("Unhandled error processing file %s: %s", file['name'], result)
+
+async def process_changes(
+    files: list,
+    channel_pk: int,
+    page_token: Optional[str],
+    next_page_token: str
+):
+    """Process a batch of changed files, then advance the channel's token.
+    
+    The token only moves once every file in the batch is settled (see
+    settled_file_ids), so transient failures and cancelled or interrupted
+    files are listed again on the next notification, while permanent
+    failures don't hold it back.
+    """
+    if files:
+        await process_files(files)
+    
+    ids = [f['id'] for f in files]
+    try:
+        with SessionLocal() as db:
+            done = len(settled_file_ids(db, ids))
+            if done < len(ids):
+                logger.warning(
+                    "%d of %d files not settled; keeping page token for retry",
+                    len(ids) - done, len(ids)
+                )
+                return
+            advance_page_token(db, channel_pk, page_token, next_page_token)
+    except Exception as e:
+        logger.error("Failed to advance page token: %s", e)
 
 @app.post("/webhook")
 async def drive_webhook(
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     x_goog_channel_id: Optional[str] = Header(None),
     x_goog_resource_state: Optional[str] = Header(None)
 ):
-    print(f"Received webhook notification - Channel: {x_goog_channel_id}, State: {x_goog_resource_state}")
+    logger.info("Received webhook notification - Channel: %s, State: %s", x_goog_channel_id, x_goog_resource_state)
     
     if not x_goog_channel_id or not x_goog_resource_state:
-        print("Missing required headers in webhook request")
+        logger.warning("Missing required headers in webhook request")
         raise HTTPException(status_code=400, detail="Missing required headers")
     
     # Handle sync notification immediately
@@ -159,22 +282,29 @@ async def drive_webhook(
         return JSONResponse(status_code=200, content={"status": "trash ignored"})
         
     try:
-        # Get active channel with minimal query
-        channel = db.query(NotificationChannel.folder_id)\
-            .filter_by(channel_id=x_goog_channel_id)\
-            .first()
-            
+        # Get the channel's folder and change-tracking position in one query
+        channel = db.query(
+            NotificationChannel.id,
+            NotificationChannel.folder_id,
+            NotificationChannel.start_page_token
+        ).filter_by(channel_id=x_goog_channel_id).first()
+        
         if not channel:
             return JSONResponse(status_code=200, content={"status": "ignored"})
-            
+        
+        # End the read so no connection is held during the Drive calls
+        db.commit()
     except Exception as e:
-        print(f"[WARN] Database error: {str(e)}")
+        logger.warning("Database error: %s", e)
         # Return success to prevent Google from retrying
         return JSONResponse(status_code=200, content={"status": "error"})
     
+    folder_id = channel.folder_id
+    page_token = channel.start_page_token
+    
     # Check debounce
     current_time = time()
-    last_check = LAST_CHECK_TIME.get(channel.folder_id, 0)
+    last_check = LAST_CHECK_TIME.get(folder_id, 0)
     
     if current_time - last_check < DEBOUNCE_INTERVAL:
         return JSONResponse(
@@ -182,31 +312,60 @@ async def drive_webhook(
             content={"status": "debounced"}
         )
     
-    LAST_CHECK_TIME[channel.folder_id] = current_time
+    try:
+        acquired = acquire_folder_check(
+            db, folder_id, timedelta(seconds=DEBOUNCE_INTERVAL)
+        )
+    except Exception as e:
+        logger.warning("Debounce check failed, using local state only: %s", e)
+        db.rollback()
+        acquired = True
+    
+    if not acquired:
+        return JSONResponse(
+            status_code=200,
+            content={"status": "debounced"}
+        )
+    
+    # Record locally and drop expired entries so the dict stays bounded
+    LAST_CHECK_TIME[folder_id] = current_time
+    for checked_folder, checked_at in list(LAST_CHECK_TIME.items()):
+        if current_time - checked_at >= DEBOUNCE_INTERVAL:
+            del LAST_CHECK_TIME[checked_folder]
     
-    print(f"[INFO] Checking folder: {channel.folder_id} (Last check: {int(current_time - last_check)}s ago)")
-    new_files = await drive_service.list_new_files(channel.folder_id)
-    print(f"Found {len(new_files)} files in folder")
+    logger.info("Checking folder: %s", folder_id)
+    try:
+        if page_token is None:
+            # Channels created before change tracking: take a token first so
+            # nothing is missed, then fall back to a one-off recent listing
+            next_page_token = await drive_service.get_start_page_token()
+            new_files = await drive_service.list_recent_files(folder_id)
+        else:
+            new_files, next_page_token = await drive_service.list_new_files(folder_id, page_token)
+    except Exception as e:
+        logger.error("Failed to list changes for folder %s: %s", folder_id, e)
+        db.rollback()
+        return JSONResponse(status_code=200, content={"status": "error"})
+    logger.info("Found %d changed files in folder", len(new_files))
     
-    # Filter out already processed files
-    processed_ids = {f[0] for f in db.query(ProcessedFile.file_id).all()}
-    new_files = [f for f in new_files if f['id'] not in processed_ids]
-    print(f"Found {len(new_files)} new unprocessed files")
+    # Filter out processed and given-up files, looking up only the candidate IDs
+    settled_ids = settled_file_ids(db, [f['id'] for f in new_files])
+    new_files = [f for f in new_files if f['id'] not in settled_ids]
+    logger.info("Found %d new unprocessed files", len(new_files))
         
     try:
-        # Process new files in background
-        for file in new_files:
-            background_tasks.add_task(
-                process_file,
-                file['id'],
-                file['name'],
-                db
-            )
+        # Process new files concurrently after responding; the page token
+        # advances once they are all recorded
+        task = asyncio.create_task(
+            process_changes(new_files, channel.id, page_token, next_page_token)
+        )
+        fanout_tasks.add(task)
+        task.add_done_callback(fanout_tasks.discard)
         
         return JSONResponse(
             status_code=200,
             content={"status": "processing", "files": len(new_files)}
         )
     except Exception as e:
-        print(f"[ERROR] Failed to process files: {str(e)}")
+        logger.error("Failed to process files: %s", e)
         return JSONResponse(status_code=200, content={"status": "error"})
\ No newline at end of file
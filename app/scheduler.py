@@ -1,21 +1,28 @@
 from datetime import datetime, timedelta
+import logging
 from typing import Optional
 from sqlalchemy.orm import Session
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from .database import SessionLocal, NotificationChannel
-from .google_drive import GoogleDriveService
+from .google_drive import get_drive_service
 
+logger = logging.getLogger(__name__)
 scheduler = AsyncIOScheduler()
 
+RENEWAL_INTERVAL = timedelta(hours=12)
+# Renew anything expiring before the run after next, with a safety margin
+RENEWAL_LOOKAHEAD = RENEWAL_INTERVAL + timedelta(hours=6)
+
 async def renew_channels():
     """Renew notification channels that are about to expire."""
     db = SessionLocal()
-    drive_service = GoogleDriveService()
+    drive_service = get_drive_service()
     
     try:
-        # Find channels expiring in next 6 hours
-        expiration_threshold = datetime.utcnow() + timedelta(hours=6)
+        # Find channels expiring before the next run, including any that
+        # have already expired so their folders are watched again
+        expiration_threshold = datetime.utcnow() + RENEWAL_LOOKAHEAD
         channels = db.query(NotificationChannel).filter(
             NotificationChannel.expiration <= expiration_threshold
         ).all()
@@ -31,15 +38,18 @@ async def renew_channels():
                 # Update database
                 channel.channel_id = new_channel['channel_id']
                 channel.expiration = new_channel['expiration']
+                # Keep the existing position so no changes are skipped
+                if channel.start_page_token is None:
+                    channel.start_page_token = new_channel['start_page_token']
                 db.commit()
                 
-                print(f"Renewed channel for folder {channel.folder_id}")
+                logger.info("Renewed channel for folder %s", channel.folder_id)
             except Exception as e:
-                print(f"Error renewing channel {channel.channel_id}: {str(e)}")
+                logger.error("Error renewing channel %s: %s", channel.channel_id, e)
                 db.rollback()
     finally:
         db.close()
 
 def start_scheduler():
-    scheduler.add_job(renew_channels, 'interval', hours=12)
+    scheduler.add_job(renew_channels, 'interval', seconds=RENEWAL_INTERVAL.total_seconds())
     scheduler.start()